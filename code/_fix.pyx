@@ -0,0 +1,53 @@
+# cython: language_level=3
+"""
+C implementation of the per-value helpers of rpc_legacyproxy
+
+Build it next to the script with ``cythonize -i _fix.pyx``,
+rpc_legacyproxy falls back to pure python when it is missing
+"""
+
+
+cdef inline long timedelta_multiplier(Py_UCS4 suffix):
+    if suffix == u's':
+        return 1
+    if suffix == u'm':
+        return 60
+    if suffix == u'h':
+        return 3600
+    if suffix == u'd':
+        return 1  # day-sized in legacy zabbix
+    if suffix == u'w':
+        return 7
+    return 0
+
+
+cpdef object fix_timedelta(object value):
+    if not isinstance(value, str):
+        return value
+
+    cdef str s = <str>value
+    cdef Py_ssize_t length = len(s)
+    cdef Py_ssize_t i = 0
+    cdef Py_UCS4 c
+    cdef long multiplier
+
+    while i < length:
+        c = s[i]
+        if c < u'0' or c > u'9':
+            break
+        i += 1
+    # only '<digits><suffix>' is rewritten, bare integers are kept as is
+    if i == 0 or i != length - 1:
+        return value
+    multiplier = timedelta_multiplier(s[i])
+    if multiplier == 0:
+        return value
+    return str(int(s[:i]) * multiplier)
+
+
+cpdef fix_item(dict item):
+    # replacing values of existing keys is safe while iterating
+    for key, value in item.items():
+        fixed = fix_timedelta(value)
+        if fixed is not value:
+            item[key] = fixed
@@ -0,0 +1,66 @@
+import json
+import os
+import re
+import signal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import setproctitle
+except ImportError:  # pragma: no cover
+    setproctitle = None
+
+# json.dumps() builds a new encoder per call for non-default options
+json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+# orjson reads integers wider than 64 bits as floats and cannot write them,
+# payloads that may contain such numbers go through the json module
+long_number_rx = re.compile(rb'\d{19}')
+
+
+def stdlib_json_dumps(content) -> bytes:
+    return json_encoder.encode(content).encode('utf-8')
+
+
+if orjson is not None:
+    def json_loads(data: bytes):
+        if long_number_rx.search(data):
+            return json.loads(data)
+        return orjson.loads(data)
+
+    def json_dumps(content) -> bytes:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            return stdlib_json_dumps(content)
+else:
+    json_loads = json.loads
+    json_dumps = stdlib_json_dumps
+
+
+def fork_workers(count: int, title: str) -> list:
+    """
+    Fork count - 1 worker processes serving the same SO_REUSEPORT port,
+    return the worker pids in the parent and an empty list in workers
+    """
+    pids = []
+    for number in range(1, count):
+        pid = os.fork()
+        if pid == 0:
+            if setproctitle is not None:
+                setproctitle.setproctitle('{} worker {}'.format(title, number))
+            return []
+        pids.append(pid)
+    return pids
+
+
+def stop_workers(pids: list):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
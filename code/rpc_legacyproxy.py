@@ -1,4 +1,4 @@
-import json
+import asyncio
 import logging
 import os
 import re
@@ -6,69 +6,136 @@ import re
 import aiohttp
 from aiohttp import (ClientConnectionError, ClientOSError, ClientResponse,
                      hdrs, web)
-from multidict import CIMultiDict
+
+from proxy_common import fork_workers, json_dumps, json_loads, stop_workers
+
+try:
+    import _fix
+except ImportError:  # pragma: no cover
+    _fix = None
+
+try:
+    import cysimdjson
+except ImportError:  # pragma: no cover
+    cysimdjson = None
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
 
 os.environ.setdefault('ZBX_API', 'http://127.0.0.1')
 
 ZABBIX_RPC_URL = os.environ['ZBX_API']
+UPSTREAM_PREFIX = ZABBIX_RPC_URL.rstrip('/?')
 PROXY_PORT = 80
+PROXY_WORKERS = int(os.environ.get('PROXY_WORKERS', os.cpu_count() or 1))
 
 logger = logging.getLogger(__name__)
 
-timedelta_rx = re.compile(r'(?P<value>\d+)(?P<suffix>[smhdw]?)')
+if cysimdjson is not None:
+    simdjson_parser = cysimdjson.JSONParser()
+else:
+    simdjson_parser = None
+
+
+suffixed_value_rx = re.compile(rb'"\d+[smhdw]"')
+method_rx = re.compile(rb'"method"\s*:\s*"([^"\\]*)"')
+interface_fields = ('main', 'type', 'useip', 'ip', 'dns', 'port')
+timedelta_multipliers = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 1,  # day-sized in legacy zabbix
+    'w': 7,
+    # 'd': 86400,
+    # 'w': 604800,
+}
 
 
 def fix_timedelta(value):
-    if not isinstance(value, str):
+    if not isinstance(value, str) or value.isdigit():
         return value
-    r = timedelta_rx.match(value)
-    if not r:
+    multiplier = timedelta_multipliers.get(value[-1:])
+    digits = value[:-1]
+    # only '<digits><suffix>' is rewritten, strip() leaves nothing of them
+    if multiplier is None or not digits or digits.strip('0123456789'):
         return value
+    return str(int(digits) * multiplier)
+
+
+def fix_item(item: dict):
+    """
+    Fix time suffixed values of item in place
+    """
+    for key, value in item.items():
+        fixed = fix_timedelta(value)
+        if fixed is not value:
+            item[key] = fixed
+
+
+if _fix is not None:
+    fix_timedelta = _fix.fix_timedelta  # noqa: F811
+    fix_item = _fix.fix_item  # noqa: F811
+
+
+def result_needs_fix(body: bytes) -> bool:
+    """
+    Lazily walk body['result'] without building Python objects and tell
+    whether any item would be changed by fix_json_response
+    """
+    if b'"interfaces"' not in body and not suffixed_value_rx.search(body):
+        return False
+    if simdjson_parser is None:
+        return True
     try:
-        value = int(r.group('value'))
-        suffix = r.group('suffix')
-        multipliers = {
-            'm': 60,
-            'h': 3600,
-            'd': 1,  # day-sized in legacy zabbix
-            'w': 7,
-            # 'd': 86400,
-            # 'w': 604800,
-        }
-        return str(value * multipliers.get(suffix, 1))
-    except ValueError:
-        return value
+        document = simdjson_parser.parse(body)
+        if not isinstance(document, cysimdjson.JSONObject):
+            return True
+        result = document.at_pointer('/result')
+    except (KeyError, RuntimeError, TypeError, ValueError):
+        # e.g. invalid JSON or integers wider than 64 bits (BIGINT_ERROR),
+        # let the regular json path decide what to do with it
+        return True
+    if not isinstance(result, cysimdjson.JSONArray):
+        return True
+
+    for item in result:
+        if not isinstance(item, cysimdjson.JSONObject) or 'interfaces' in item:
+            return True
+        for _, value in item.items():
+            if isinstance(value, str) and fix_timedelta(value) != value:
+                return True
+    return False
 
 
 async def fix_json_response(response: ClientResponse, method: str) -> bytes:
     body = await response.read()
-    logger.debug('  ..with data {}'.format(body))
+    logger.debug('  ..with data %s', body)
+    if not result_needs_fix(body):
+        return body
     try:
-        content = json.loads(body)
+        content = json_loads(body)
     except ValueError:
-        logger.error("Not a JSON response: {}".format(body))
+        logger.error("Not a JSON response: %s", body)
         return body
 
     if not isinstance(content, dict):
-        logger.warning("Content is not a dict: {}".format(content))
+        logger.warning("Content is not a dict: %s", content)
         return body
 
     result = content.get('result')
     if not isinstance(result, list):
-        logger.debug("Result is not a list: {}".format(result))
+        logger.debug("Result is not a list: %s", result)
         return body
 
-    fixed_result = []
     for item in result:
-        new_item = {
-            key: fix_timedelta(value)
-            for key, value in item.items()
-        }
-        if 'interfaces' in new_item and isinstance(new_item['interfaces'], list):
-            interface = new_item['interfaces'][0]
-            for f in ['main', 'type', 'useip', 'ip', 'dns', 'port']:
-                new_item[f] = interface.get(f, '')
-        fixed_result.append(new_item)
+        fix_item(item)
+        interfaces = item.get('interfaces')
+        if interfaces and isinstance(interfaces, list):
+            interface = interfaces[0]
+            for f in interface_fields:
+                item[f] = interface.get(f, '')
 
     # if method == 'host.get':
     #     for item in result:
@@ -77,131 +144,206 @@ async def fix_json_response(response: ClientResponse, method: str) -> bytes:
     #             for f in ['main', 'type', 'useip', 'ip', 'dns', 'port']:
     #                 item[f] = interface.get(f, '')
 
-    content['result'] = fixed_result
-    return json.dumps(content, ensure_ascii=False).encode('utf-8')
+    return json_dumps(content)
+
+
+def fix_login_request(content: dict, method: str):
+    content['method'] = 'user.login'
+    content.pop('auth', None)
+
+
+def fix_usermacro_get_request(content: dict, method: str):
+    params = content.get('params', {})
+    if params.get('output') == 'refer':
+        params['output'] = [
+            # 'globalmacroid',
+            # 'hostid',
+            'hostmacroid',
+            # 'macro',
+            # 'value',
+            # 'description',
+            # 'type',
+        ]
+    content['params'] = params
+
+
+# legacy 'select_<field>' params and their current 'select<Field>' names
+select_params = {
+    f'select_{field}': f'select{field.title()}'
+    for field in ['macros', 'groups', 'hosts', 'dependencies', 'items']
+}
+
+
+def fix_get_request(content: dict, method: str):
+    params = content.get('params', {})
+    for legacy_param, param in select_params.items():
+        value = params.pop(legacy_param, None)
+        if value:
+            params[param] = value
+
+    if method.startswith('host.'):  # for interfaces
+        params['selectInterfaces'] = 'extend'
+    content['params'] = params
+
+
+def fix_host_create_request(content: dict, method: str):
+    params = content.get('params', {})
+    single = False
+    if not isinstance(params, list):
+        params = [params]
+        single = True
+    new_params = []
+    for p in params:
+        interface = {}
+        for f in ['ip', 'port', 'dns']:
+            interface[f] = p.pop(f, '')
+        for f in ['useip']:
+            interface[f] = p.pop(f, 0)
+        interface['type'] = 1
+        interface['main'] = 1
+        p['interfaces'] = [interface]
+        new_params.append(p)
+    if single:
+        params = params[0]
+    content['params'] = params
+
+
+request_fixers = {
+    'user.authenticate': fix_login_request,
+    'user.login': fix_login_request,
+    'usermacro.get': fix_usermacro_get_request,
+    'host.create': fix_host_create_request,
+}
+
+
+def get_request_fixer(method: str):
+    fixer = request_fixers.get(method)
+    if fixer is None and method.endswith('.get'):
+        fixer = fix_get_request
+    return fixer
 
 
 async def get_fixed_request_content(request: web.Request):
+    data = await request.read()
+    methods = method_rx.findall(data)
+    if len(methods) == 1:
+        method = methods[0].decode('utf-8', 'replace')
+        if get_request_fixer(method) is None:
+            return data, method
+
     try:
-        content = await request.json()
+        content = json_loads(data)
     except ValueError:
-        return request.content
+        return data, None
     try:
         method = content.get('method')
     except AttributeError:
-        return request.content
-
-    if method in ['user.authenticate', 'user.login']:
-        content['method'] = 'user.login'
-        content.pop('auth', None)
-    if method in ['usermacro.get']:
-        params = content.get('params', {})
-        if params.get('output') == 'refer':
-            params['output'] = {
-                'usermacro.get': [
-                    # 'globalmacroid',
-                    # 'hostid',
-                    'hostmacroid',
-                    # 'macro',
-                    # 'value',
-                    # 'description',
-                    # 'type',
-                ],
-            }.get(method, 'extend')
-        content['params'] = params
-    elif method.endswith('.get'):
-        params = content.get('params', {})
-        for field in ['macros', 'groups', 'hosts', 'dependencies', 'items']:
-            value = params.pop(f'select_{field}', None)
-            if value:
-                params[f'select{field.title()}'] = value
-
-        if method.startswith('host.'):  # for interfaces
-            params['selectInterfaces'] = 'extend'
-        content['params'] = params
-    elif method in ['host.create']:
-        params = content.get('params', {})
-        single = False
-        if not isinstance(params, list):
-            params = [params]
-            single = True
-        new_params = []
-        for p in params:
-            interface = {}
-            for f in ['ip', 'port', 'dns']:
-                interface[f] = p.pop(f, '')
-            for f in ['useip']:
-                interface[f] = p.pop(f, 0)
-            interface['type'] = 1
-            interface['main'] = 1
-            p['interfaces'] = [interface]
-            new_params.append(p)
-        if single:
-            params = params[0]
-        content['params'] = params
-
-    return json.dumps(content, ensure_ascii=False), method
+        return data, None
+    if not isinstance(method, str):
+        return data, method
+
+    fixer = get_request_fixer(method)
+    if fixer is None:
+        return data, method
+    fixer(content, method)
+    return json_dumps(content), method
+
+
+skip_request_headers = frozenset(header.lower() for header in [
+    hdrs.HOST,
+    hdrs.CONNECTION,
+    hdrs.COOKIE,
+    hdrs.CONTENT_LENGTH,
+    hdrs.CONTENT_ENCODING,
+])
+skip_response_headers = frozenset(header.lower() for header in [
+    hdrs.CONTENT_LENGTH,
+    hdrs.CONTENT_ENCODING,
+    hdrs.TRANSFER_ENCODING,
+])
+
+
+def filter_headers(headers, skip: frozenset) -> list:
+    return [
+        (name, value)
+        for name, value in headers.items()
+        if name.lower() not in skip
+    ]
 
 
 async def handler_path(request: web.Request):
-    path = request.raw_path
-    upstream_url = '{}{}'.format(ZABBIX_RPC_URL.rstrip('/?'), path)
-    req_headers = CIMultiDict(request.headers)
-    for header in [
-        hdrs.HOST,
-        hdrs.CONNECTION,
-        hdrs.COOKIE,
-        hdrs.CONTENT_LENGTH,
-        hdrs.CONTENT_ENCODING,
-    ]:
-        if header in req_headers:
-            del req_headers[header]
+    upstream_url = UPSTREAM_PREFIX + request.raw_path
+    req_headers = filter_headers(request.headers, skip_request_headers)
     data, method = await get_fixed_request_content(request)
-    async with aiohttp.ClientSession() as client:
-        try:
-            logger.info('Fetch {} with {}'.format(upstream_url, data))
-            async with client.request(
-                request.method,
-                upstream_url,
-                data=data,
-                headers=req_headers,
-            ) as resp:
-                if 200 <= resp.status < 300:
-                    body = await fix_json_response(resp, method)
-                    logger.info(f'--> Updated: {body}')
-                else:
-                    body = await resp.read()
-                resp_headers = CIMultiDict(resp.headers)
-                for header in [
-                    hdrs.CONTENT_LENGTH,
-                    hdrs.CONTENT_ENCODING,
-                    hdrs.TRANSFER_ENCODING,
-                ]:
-                    if header in resp_headers:
-                        del resp_headers[header]
-                return web.Response(
-                    body=body,
+    client = request.app['session']
+    try:
+        logger.info('Fetch %s with %s', upstream_url, data)
+        async with client.request(
+            request.method,
+            upstream_url,
+            data=data,
+            headers=req_headers,
+        ) as resp:
+            resp_headers = filter_headers(resp.headers, skip_response_headers)
+            if not 200 <= resp.status < 300:
+                # nothing to rewrite, pass the body through as it arrives
+                response = web.StreamResponse(
                     status=resp.status,
                     headers=resp_headers,
                 )
-        except (ClientOSError, ClientConnectionError):
-            logger.exception(
-                "Cannot connect to upstream {}".format(upstream_url),
-            )
+                await response.prepare(request)
+                async for chunk in resp.content.iter_chunked(65536):
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+
+            body = await fix_json_response(resp, method)
+            logger.info('--> Updated: %s', body)
             return web.Response(
-                body=b'{}',
-                status=500,
-                content_type='application/json',
+                body=body,
+                status=resp.status,
+                headers=resp_headers,
             )
+    except (ClientOSError, ClientConnectionError):
+        logger.exception("Cannot connect to upstream %s", upstream_url)
+        return web.Response(
+            body=b'{}',
+            status=500,
+            content_type='application/json',
+        )
+
+
+async def on_startup(app: web.Application):
+    # the session is shared by all clients, never keep upstream cookies
+    app['session'] = aiohttp.ClientSession(
+        cookie_jar=aiohttp.DummyCookieJar(),
+        connector=aiohttp.TCPConnector(
+            limit=200,
+            keepalive_timeout=85,
+            enable_cleanup_closed=True,
+        ),
+    )
+
+
+async def on_cleanup(app: web.Application):
+    await app['session'].close()
 
 
 def main():
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    workers = fork_workers(PROXY_WORKERS, 'rpc_legacyproxy')
 
     app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     app.router.add_route(hdrs.METH_ANY, r'/{path:.*}', handler_path)
     app.router.add_route(hdrs.METH_ANY, r'', handler_path)
-    web.run_app(app, port=PROXY_PORT)
+    try:
+        web.run_app(app, port=PROXY_PORT, reuse_port=True)
+    finally:
+        stop_workers(workers)
 
 
 if __name__ == '__main__':
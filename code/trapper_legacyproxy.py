@@ -1,16 +1,24 @@
 import asyncio
-import json
 import logging
 import os
 import re
+import signal
 import struct
 
+from proxy_common import fork_workers, json_dumps, json_loads, stop_workers
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
 logger = logging.getLogger(__name__)
 os.environ.setdefault('ZBX_SERVER', '127.0.0.1')
 os.environ.setdefault('ZBX_PORT', '10051')
 
 PROXY_ADDRESS = '0.0.0.0'
 PROXY_PORT = 10051
+PROXY_WORKERS = int(os.environ.get('PROXY_WORKERS', os.cpu_count() or 1))
 
 ZABBIX_SERVER = os.environ['ZBX_SERVER']
 ZABBIX_PORT = int(os.environ['ZBX_PORT'])
@@ -18,26 +26,27 @@ ZABBIX_PORT = int(os.environ['ZBX_PORT'])
 info_rx = re.compile(
     r"processed: (\d+); failed: (\d+); total: (\d+); seconds spent: ([\d.]+)",
 )
+info_marker = b'processed:'
 info_replacement = "Processed {} Failed {} Total {} Seconds spent {}"
+agent_data_replacements = [
+    (b'"request":"agent data"', b'"request":"sender data"'),
+    (b'"request": "agent data"', b'"request": "sender data"'),
+]
+
+
+zbxd_header = struct.Struct('<4sBQ')
 
 
 def get_packet_length(header: bytes) -> int:
-    header, flags, length = struct.unpack('<4sBQ', header)
+    header, flags, length = zbxd_header.unpack_from(header)
     assert header == b'ZBXD'
     assert flags == 1
     assert length != 0
     return length
 
 
-def packed2data(packed_data: bytes) -> bytes:
-    length = get_packet_length(packed_data[:13])
-    (data, ) = struct.unpack('<%ds' % length, packed_data[13:13+length])
-    return data
-
-
 def data2packed(data: bytes) -> bytes:
-    header_field = struct.pack('<4sBQ', b'ZBXD', 1, len(data))
-    return header_field + data
+    return zbxd_header.pack(b'ZBXD', 1, len(data)) + data
 
 
 class ZabbixLegacyClientProxy:
@@ -46,14 +55,20 @@ class ZabbixLegacyClientProxy:
         """
         In request['request'] replace 'agent data' with 'sender data'
         """
+        for legacy, upgraded in agent_data_replacements:
+            if legacy in data:
+                return data.replace(legacy, upgraded, 1)
+        if b'agent data' not in data:
+            return data
+
         upgraded = False
-        content = json.loads(data)
+        content = json_loads(data)
         if content['request'] == 'agent data':
             content['request'] = 'sender data'
             upgraded = True
 
         if upgraded:
-            return json.dumps(content).encode('utf-8')
+            return json_dumps(content)
         return data
 
     @staticmethod
@@ -62,13 +77,16 @@ class ZabbixLegacyClientProxy:
         Fix response['info']
         """
 
+        if info_marker not in data:
+            return data
+
         upgraded = False
         try:
-            content = json.loads(data)
+            content = json_loads(data)
         except ValueError:
             return data
-        if isinstance(content, dict):
-            r = info_rx.match(content.get('info'))
+        if isinstance(content, dict) and isinstance(content.get('info'), str):
+            r = info_rx.match(content['info'])
             if r:
                 content['info'] = info_replacement.format(
                     r.group(1),
@@ -78,21 +96,21 @@ class ZabbixLegacyClientProxy:
                 )
                 upgraded = True
         if upgraded:
-            return json.dumps(content).encode('utf-8')
+            return json_dumps(content)
         return data
 
     @classmethod
     async def request_replacer(cls, reader, writer):
         try:
-            header = await reader.read(13)
+            header = await reader.readexactly(zbxd_header.size)
             length = get_packet_length(header)
-            data = await reader.read(length)
+            data = await reader.readexactly(length)
             try:
                 data = cls.upgrade_request(data)
                 data = data2packed(data)
             except (IndexError, ValueError, struct.error):
                 data = header + data
-                logger.exception("Cannot upgrade request {}".format(data))
+                logger.exception("Cannot upgrade request %s", data)
             writer.write(data)
             while not reader.at_eof():
                 await reader.read(1024)
@@ -102,17 +120,20 @@ class ZabbixLegacyClientProxy:
 
     @classmethod
     async def response_replacer(cls, reader, writer):
-        buffer = b''
+        header = payload = b''
         try:
-            while not reader.at_eof():
-                buffer += await reader.read(2048)
             try:
-                data = packed2data(buffer)
-                data = cls.upgrade_response(data)
+                header = await reader.readexactly(zbxd_header.size)
+                payload = await reader.readexactly(get_packet_length(header))
+                data = cls.upgrade_response(payload)
                 data = data2packed(data)
-            except (IndexError, ValueError, struct.error):
-                logger.exception("Cannot upgrade response {}".format(buffer))
-                data = buffer
+            except asyncio.IncompleteReadError as e:
+                # pass a truncated reply through as it is
+                data = header + e.partial
+                logger.error("Truncated response %s", data)
+            except (AssertionError, IndexError, ValueError, struct.error):
+                data = header + payload + await reader.read()
+                logger.exception("Cannot upgrade response %s", data)
             writer.write(data)
         finally:
             await writer.drain()
@@ -121,8 +142,13 @@ class ZabbixLegacyClientProxy:
     @classmethod
     async def transparent_pipe(cls, reader, writer):
         try:
-            while not reader.at_eof():
-                writer.write(await reader.read(2048))
+            # StreamReader iterates by lines, read whatever is buffered
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
         finally:
             writer.close()
 
@@ -150,17 +176,23 @@ class ZabbixLegacyClientProxy:
 
 
 def main():
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    workers = fork_workers(PROXY_WORKERS, 'trapper_legacyproxy')
     loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
 
     proxy = ZabbixLegacyClientProxy()
     server = loop.run_until_complete(proxy.run())
 
-    # Serve requests until Ctrl+C is pressed
+    # Serve requests until Ctrl+C is pressed or SIGTERM is received
     print('Serving on {}:{}'.format(*server.sockets[0].getsockname()))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        stop_workers(workers)
 
     # Close the server
     server.close()